@@ -5,16 +5,20 @@ import json
 import os
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, ContextTypes, ConversationHandler, filters,
+    Application, ApplicationHandlerStop, CommandHandler, MessageHandler, TypeHandler, ContextTypes, ConversationHandler, filters,
 )
 from datetime import datetime, timedelta
 import pytz  # Для работы с часовыми поясами
-from config import BOT_TOKEN, APPLICATION_KEY
-from retrieve_schedule import get_schedule  # Импортируем функцию для получения расписания
+from config import (
+    BOT_TOKEN, APPLICATION_KEY, IDLE_USER_TTL, IDLE_SWEEP_INTERVAL, LOGIN_TIMEOUT, USER_DATA_SIZE, LOGIN_STATE_SIZE,
+)
+from retrieve_schedule import get_schedule, get_user_entry, save_user_token  # Импортируем функции для получения расписания и данных пользователя
 from data_parsing import authenticate_user  # Функция для авторизации
-
-# Путь к файлу, где будут храниться данные пользователей
-USER_DATA_FILE = "users.json"
+from throttling import (  # Ограничение частоты запросов
+    check_rate_limit, acquire_upstream_call, should_notify, refund_user, get_throttle_stats, expire_idle_state,
+    UpstreamBusyError, UPSTREAM_BUSY_REPLY,
+)
+from cache import BoundedCache, user_index, schedule_cache  # Ограниченные по размеру кэши
 
 # Настройка логирования
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
@@ -43,52 +47,15 @@ logger = logging.getLogger(__name__)
 # Шаги для ConversationHandler
 LOGIN, PASSWORD = range(2)
 
+# Пользователи, которые начали авторизацию, но ещё не ввели пароль
+pending_logins = BoundedCache(LOGIN_STATE_SIZE, ttl=LOGIN_TIMEOUT)
+
 # Московский часовой пояс
 MOSCOW_TZ = pytz.timezone("Europe/Moscow")
 
-# Функция для загрузки данных пользователей из JSON файла
-def load_user_data():
-    if os.path.exists(USER_DATA_FILE):
-        try:
-            with open(USER_DATA_FILE, "r", encoding="utf-8") as file:
-                return json.load(file)
-        except json.JSONDecodeError:
-            logger.error(f"Файл {USER_DATA_FILE} повреждён. Создаём новый файл.")
-            return {}  # Возвращаем пустой словарь, если JSON невалиден
-    else:
-        # Если файл не существует, создаем новый
-        logger.info(f"Файл {USER_DATA_FILE} не найден. Создаём новый файл.")
-        return {}
-
-# Функция для сохранения данных пользователей в JSON файл
-def save_user_data(user_data):
-    try:
-        with open(USER_DATA_FILE, "w", encoding="utf-8") as file:
-            json.dump(user_data, file, ensure_ascii=False, indent=4)
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении данных в файл: {e}")
-
-# Функция для получения токена пользователя по user_id
+# Функция для получения токена пользователя по user_id (через кэш активных пользователей)
 def get_user_token(user_id):
-    user_data = load_user_data()
-    return user_data.get(str(user_id), {}).get("token")
-
-# Функция для сохранения токена пользователя в JSON
-def save_user_token(user_id, username, token):
-    user_data = load_user_data()
-    
-    # Добавляем или обновляем информацию о пользователе
-    user_data[str(user_id)] = {
-        "username": username,
-        "token": token
-    }
-
-    try:
-        # Сохраняем обновленные данные в файл
-        save_user_data(user_data)
-        logger.info(f"Токен для пользователя {username} сохранен.")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении данных: {e}")
+    return get_user_entry(user_id).get("token")
 
 # Переопределение индексов дней недели в более понятный формат на русский язык
 def get_day_name_in_russian(day_index):
@@ -144,7 +111,16 @@ async def login(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type != 'private':
         return  # Игнорируем команду, если это не личное сообщение
 
-    logger.debug(f"Пользователь {update.message.from_user.id} начал процесс авторизации.")
+    # Число незавершённых авторизаций ограничено, чтобы состояние диалогов не росло без предела
+    user_id = update.message.from_user.id
+    pending_logins.expire()
+    if pending_logins.get(user_id) is None and len(pending_logins) >= LOGIN_STATE_SIZE:
+        logger.warning(f"Слишком много незавершённых авторизаций, пользователь {user_id} отклонён.")
+        await update.message.reply_text("Сейчас слишком много входов. Попробуйте через несколько минут.")
+        return ConversationHandler.END
+    pending_logins.set(user_id, True)
+
+    logger.debug(f"Пользователь {user_id} начал процесс авторизации.")
     await update.message.reply_text("Введите ваш логин:")
     return LOGIN
 
@@ -158,8 +134,17 @@ async def get_login(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Получение пароля и авторизация
 async def get_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     password = update.message.text
-    login = context.user_data["login"]
+    login = context.user_data.pop("login", None)  # Логин больше не нужен, не храним его в памяти
     user_id = update.message.from_user.id  # Получаем user_id
+    pending_logins.pop(user_id)
+
+    # Авторизация обращается к msapi, поэтому тоже расходует общий лимит
+    try:
+        acquire_upstream_call()
+    except UpstreamBusyError:
+        logger.warning(f"Общий лимит запросов к серверу исчерпан, авторизация пользователя {user_id} отложена.")
+        await update.message.reply_text(UPSTREAM_BUSY_REPLY)
+        return ConversationHandler.END
 
     # Авторизация
     application_key = APPLICATION_KEY  # Укажите свой application_key
@@ -179,6 +164,30 @@ async def get_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Ошибка авторизации. Попробуйте снова.")
         return ConversationHandler.END
 
+# Сколько запросов к серверу расписания потребует сообщение (без обращения к файлам и сети)
+def count_upstream_calls(text):
+    if text in ["Сегодня", "Завтра"]:
+        return 1
+    if text in ["Расписание на неделю", "Расписание на следующую неделю"]:
+        return 5  # Понедельник - Пятница
+    try:
+        datetime.strptime(text, "%Y-%m-%d")
+        return 1
+    except (TypeError, ValueError):
+        return 0
+
+# Проверка лимитов до всех остальных обработчиков и до любой работы с файлами и сетью
+async def throttle_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if message is None or message.from_user is None or message.chat.type != 'private':
+        return  # Такие обновления обработчики всё равно игнорируют
+
+    rejection = check_rate_limit(message.from_user.id, count_upstream_calls(message.text))
+    if rejection is not None:
+        if rejection:
+            await message.reply_text(rejection)
+        raise ApplicationHandlerStop
+
 # Обработка текстовых сообщений (например, выбор расписания)
 async def handle_date_request(update: Update, context: ContextTypes.DEFAULT_TYPE, invalid_token=False):
     if update.message.chat.type != 'private':
@@ -228,35 +237,94 @@ async def handle_date_request(update: Update, context: ContextTypes.DEFAULT_TYPE
                 await update.message.reply_text(f"📆 {date} - Расписание:\n\n{schedule_info}")
             except ValueError:
                 pass
+    except UpstreamBusyError:
+        # Расписание на день так и не запросили - возвращаем списанный токен
+        refund_user(user_id, 1)
+        if should_notify(user_id):
+            logger.warning(f"Общий лимит запросов к серверу исчерпан, запрос пользователя {user_id} отклонён.")
+            await update.message.reply_text(UPSTREAM_BUSY_REPLY)
     except ValueError:
         pass
 
-# Показать расписание на неделю
-async def show_week_schedule(update: Update, token):
-    today = datetime.now(MOSCOW_TZ)
-    start_of_week = today - timedelta(days=today.weekday())
+# Расписание на 5 дней начиная с понедельника start_of_week.
+# Если общий лимит закончился посреди недели, отправляем уже полученные дни
+# и возвращаем пользователю токены за незапрошенные.
+async def reply_week_schedule(update: Update, start_of_week):
+    user_id = update.message.from_user.id
     week_schedule = ""
 
-    for i in range(5):
+    for i in range(5):  # Понедельник - Пятница
         date = (start_of_week + timedelta(days=i)).strftime("%Y-%m-%d")
         day_name = get_day_name_in_russian((start_of_week + timedelta(days=i)).weekday())
-        schedule_info = get_schedule(date, update.message.from_user.id)
+        try:
+            schedule_info = get_schedule(date, user_id)
+        except UpstreamBusyError:
+            refund_user(user_id, 5 - i)
+            logger.warning(f"Общий лимит запросов к серверу исчерпан, пользователь {user_id} получил {i} из 5 дней.")
+            week_schedule += UPSTREAM_BUSY_REPLY
+            break
         week_schedule += f"📅 {day_name} ({date}):\n{schedule_info}\n"
 
     await update.message.reply_text(week_schedule)
 
+# Показать расписание на неделю
+async def show_week_schedule(update: Update, token):
+    today = datetime.now(MOSCOW_TZ)
+    start_of_week = today - timedelta(days=today.weekday())
+    await reply_week_schedule(update, start_of_week)
+
 async def get_next_week_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     today = datetime.now(MOSCOW_TZ)
     start_of_next_week = today + timedelta(days=(7 - today.weekday()))  # Получаем начало следующей недели
-    next_week_schedule = ""
-
-    for i in range(5):  # Понедельник - Пятница
-        date = (start_of_next_week + timedelta(days=i)).strftime("%Y-%m-%d")
-        day_name = get_day_name_in_russian((start_of_next_week + timedelta(days=i)).weekday())
-        schedule_info = get_schedule(date, update.message.from_user.id)
-        next_week_schedule += f"📅 {day_name} ({date}):\n{schedule_info}\n"
-
-    await update.message.reply_text(next_week_schedule)
+    await reply_week_schedule(update, start_of_next_week)
+
+last_sweep = time.monotonic()
+
+# Удаляем данные давно неактивных пользователей, пока их не останется keep (незавершённые авторизации не трогаем)
+def drop_oldest_user_data(application, keep):
+    candidates = [
+        (user_data.get("last_seen", 0), user_id)
+        for user_id, user_data in application.user_data.items()
+        if pending_logins.get(user_id) is None
+    ]
+    candidates.sort()
+    to_drop = candidates[:max(0, len(application.user_data) - keep)]
+    for _, user_id in to_drop:
+        application.drop_user_data(user_id)
+    return len(to_drop)
+
+# Отмечаем активность пользователя и периодически удаляем состояние неактивных
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global last_sweep
+    chat = update.effective_chat
+    if update.effective_user and chat and chat.type == 'private':
+        # Время последней активности хранится вместе с остальными данными пользователя.
+        # Групповые чаты бот игнорирует, поэтому данные для них не создаются.
+        context.user_data["last_seen"] = time.monotonic()
+
+        # Сверх USER_DATA_SIZE удаляем самых давно неактивных, с запасом в 10%, чтобы не сортировать на каждом сообщении
+        if len(context.application.user_data) > USER_DATA_SIZE:
+            dropped = drop_oldest_user_data(context.application, USER_DATA_SIZE * 9 // 10)
+            logger.warning(f"Превышен лимит USER_DATA_SIZE, удалены данные {dropped} пользователей.")
+
+    now = time.monotonic()
+    if now - last_sweep < IDLE_SWEEP_INTERVAL:
+        return
+    last_sweep = now
+
+    # Удаляем данные только тех, кто действительно не писал боту IDLE_USER_TTL секунд
+    dropped = 0
+    for user_id, user_data in list(context.application.user_data.items()):
+        seen = user_data.get("last_seen")
+        if seen is None or now - seen >= IDLE_USER_TTL:
+            context.application.drop_user_data(user_id)
+            dropped += 1
+    expired = user_index.expire() + schedule_cache.expire() + expire_idle_state() + pending_logins.expire()
+    logger.info(
+        f"Очистка памяти: удалено состояние {dropped} неактивных пользователей, {expired} устаревших записей кэша. "
+        f"В кэше пользователей: {len(user_index)}, расписаний: {len(schedule_cache)}. "
+        f"Статистика ограничения запросов: {get_throttle_stats()}"
+    )
 
 # Основной обработчик ошибок
 async def handle_error(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -267,6 +335,16 @@ def main():
 
     application = Application.builder().token(BOT_TOKEN).build()
 
+    # Без JobQueue PTB игнорирует conversation_timeout, и брошенная авторизация остаётся в памяти
+    if application.job_queue is None:
+        logger.error("JobQueue недоступен: установите python-telegram-bot[job-queue], иначе таймаут авторизации не работает.")
+
+    # Ограничение частоты запросов выполняется раньше всех обработчиков
+    application.add_handler(TypeHandler(Update, throttle_updates), group=-2)
+
+    # Отслеживание активности выполняется до остальных обработчиков
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
+
     # Обработчик команды /start
     application.add_handler(CommandHandler("start", start))
 
@@ -277,6 +355,7 @@ def main():
             PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_password)],
         },
         fallbacks=[],
+        conversation_timeout=LOGIN_TIMEOUT,  # Незавершённая авторизация не хранится бесконечно
     )
 
     application.add_handler(conversation_handler)
@@ -291,5 +370,8 @@ def main():
     # Запускаем бота
     application.run_polling()
 
+    # Итоговые счётчики ограничения частоты запросов
+    logger.info(f"Статистика ограничения запросов: {get_throttle_stats()}")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,63 @@
+import time
+from collections import OrderedDict
+from config import (
+    USER_INDEX_CACHE_SIZE, SCHEDULE_CACHE_SIZE, SCHEDULE_CACHE_TTL, IDLE_USER_TTL,
+)
+
+class BoundedCache:
+    """
+    Кэш с ограничением по размеру (вытесняются давно не использованные записи)
+    и необязательным временем жизни записи ttl в секундах.
+    """
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (время истечения, значение)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def remove_where(self, predicate):
+        # Удаляем все записи, ключ которых удовлетворяет условию
+        keys = [key for key in self._data if predicate(key)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    def expire(self):
+        # Удаляем все просроченные записи, возвращаем их количество
+        now = time.monotonic()
+        expired = [key for key, (expires_at, _) in self._data.items() if expires_at is not None and expires_at <= now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+
+# Записи пользователей из базы (только активные пользователи)
+user_index = BoundedCache(USER_INDEX_CACHE_SIZE, ttl=IDLE_USER_TTL)
+
+# Готовый текст расписания в UTF-8 по ключу (user_id, дата)
+schedule_cache = BoundedCache(SCHEDULE_CACHE_SIZE, ttl=SCHEDULE_CACHE_TTL)
@@ -18,3 +18,42 @@ REFERER = "https://journal.top-academy.ru/"
 
 # Новый параметр для получения URL для авторизации пользователей, чтобы получать актуальные токены
 AUTH_URL = "https://msapi.top-academy.ru/api/v2/auth/login"  # Пример URL для авторизации, укажите реальный, если он другой
+
+# Ограничение частоты запросов (защита от спама и перерасхода лимита msapi)
+# Персональный лимит в запросах к msapi (сообщение без запросов стоит 1):
+# максимум подряд (не меньше 5, иначе кнопки недели станут недоступны) и скорость восстановления в секунду.
+# Один пользователь не может занять больше USER_RATE_REFILL / GLOBAL_RATE_REFILL общего лимита.
+USER_RATE_CAPACITY = 10
+USER_RATE_REFILL = 0.1
+# Общий лимит обращений к msapi для всех пользователей (запросов подряд и запросов в секунду)
+GLOBAL_RATE_CAPACITY = 60
+GLOBAL_RATE_REFILL = 2.0
+# Как часто (в секундах) повторно отвечать пользователю "слишком часто", остальные сообщения игнорируются молча
+THROTTLE_NOTICE_INTERVAL = 30
+
+# База данных пользователей (SQLite), при первом запуске в неё переносится users.json
+USER_DB_FILE = "users.db"
+
+# Ограничения памяти
+# На сколько одновременно активных пользователей рассчитаны размеры кэшей
+ACTIVE_USERS_TARGET = 5000
+# Сколько записей пользователей из базы держать в памяти
+USER_INDEX_CACHE_SIZE = ACTIVE_USERS_TARGET
+# Сколько готовых текстов расписания хранить и сколько секунд они актуальны.
+# 10 дней (текущая и следующая неделя) на активного пользователя, около 1 КБ на запись:
+# при 5000 пользователях это ~50 МБ. Меньший размер экономит память, но вытесненные дни
+# снова запрашиваются у msapi и расходуют общий лимит запросов.
+SCHEDULE_CACHE_SIZE = ACTIVE_USERS_TARGET * 10
+SCHEDULE_CACHE_TTL = 600
+# Максимум пользователей, для которых хранится состояние ограничения частоты запросов
+THROTTLE_STATE_SIZE = ACTIVE_USERS_TARGET * 2
+# Максимум пользователей с данными в context.user_data, сверх него удаляются давно неактивные
+USER_DATA_SIZE = ACTIVE_USERS_TARGET * 2
+# Максимум одновременно незавершённых авторизаций
+LOGIN_STATE_SIZE = 1000
+# Через сколько секунд бездействия состояние пользователя удаляется из памяти
+IDLE_USER_TTL = 1800
+# Как часто (в секундах) проверять и удалять состояние неактивных пользователей
+IDLE_SWEEP_INTERVAL = 300
+# Сколько секунд ждать ввода логина и пароля, прежде чем прервать авторизацию
+LOGIN_TIMEOUT = 300
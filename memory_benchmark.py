@@ -0,0 +1,131 @@
+"""
+Бенчмарк потребления памяти ботом.
+
+Создаёт во временной папке базу на 100 000 зарегистрированных пользователей,
+из которых 5 000 активны: каждый активный пользователь проходит проверку лимитов,
+поиск своей записи в базе и запрашивает расписание на текущую и следующую неделю.
+Затем измеряются вход пользователя и сброс недействительного токена, а в конце -
+однократный перенос users.json того же размера в базу.
+Сеть не используется: ответ сервера расписания подменяется готовым.
+Выводит текущую и пиковую резидентную память процесса и размеры кэшей.
+Запуск: python memory_benchmark.py
+"""
+import gc
+import json
+import logging
+import os
+import resource
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import retrieve_schedule
+import user_store
+from cache import user_index, schedule_cache
+from throttling import check_rate_limit, user_buckets
+
+REGISTERED_USERS = 100_000
+ACTIVE_USERS = 5_000
+DAYS_PER_USER = 10  # Текущая и следующая неделя
+
+# Пример занятия, как его возвращает msapi
+LESSON = {
+    "started_at": "09:00",
+    "finished_at": "10:30",
+    "subject_name": "Разработка программного обеспечения",
+    "room_name": "Аудитория 301",
+    "teacher_name": "Иванов Иван Иванович",
+}
+
+class FakeResponse:
+    # Ответ сервера расписания без обращения к сети
+    status_code = 200
+
+    def json(self):
+        return [LESSON] * 4
+
+def make_user(user_id):
+    # Запись пользователя того же размера, что и в users.json (JWT около 300 символов)
+    return {"username": f"student_{user_id}", "token": "x" * 300}
+
+def write_users_file(path):
+    # Пишем старый users.json по одной записи в том же формате, что и json.dump(..., indent=4),
+    # чтобы не держать в памяти бенчмарка словарь на 100 000 пользователей
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("{")
+        for user_id in range(REGISTERED_USERS):
+            entry = json.dumps(make_user(user_id), ensure_ascii=False, indent=4).replace("\n", "\n    ")
+            file.write(f"{',' if user_id else ''}\n    \"{user_id}\": {entry}")
+        file.write("\n}")
+
+def rss_mb():
+    # Текущая резидентная память (Linux), иначе пиковая
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    # Пиковая резидентная память процесса (ru_maxrss в Linux указывается в КБ)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def main():
+    logging.disable(logging.WARNING)
+    os.chdir(tempfile.mkdtemp())  # База и users.json ищутся в текущей папке
+    user_store.import_users((user_id, make_user(user_id)) for user_id in range(REGISTERED_USERS))
+    db_size = os.path.getsize(user_store.USER_DB_FILE) / 2**20
+
+    gc.collect()
+    baseline = rss_mb()
+    baseline_peak = peak_rss_mb()
+
+    retrieve_schedule.fetch_schedule = lambda date, user_id: FakeResponse()
+
+    monday = datetime(2024, 12, 2)
+    dates = [(monday + timedelta(days=i + i // 5 * 2)).strftime("%Y-%m-%d") for i in range(DAYS_PER_USER)]
+
+    started = time.perf_counter()
+    step = REGISTERED_USERS // ACTIVE_USERS
+    for user_id in range(0, REGISTERED_USERS, step):
+        check_rate_limit(user_id, upstream_calls=1)
+        for date in dates:
+            retrieve_schedule.get_schedule(date, user_id)
+    elapsed = time.perf_counter() - started
+
+    gc.collect()
+    active = rss_mb()
+    active_peak = peak_rss_mb()
+
+    print(f"Зарегистрировано пользователей: {REGISTERED_USERS}, активных: {ACTIVE_USERS}, {user_store.USER_DB_FILE}: {db_size:.1f} МБ")
+    print(f"Время имитации: {elapsed:.2f} с")
+    print(f"Память до нагрузки: {baseline:.1f} МБ")
+    print(f"Память с активными пользователями после сборки мусора: {active:.1f} МБ (+{active - baseline:.1f} МБ)")
+    print(f"Пиковая память: {active_peak:.1f} МБ (+{active_peak - baseline_peak:.1f} МБ)")
+    print(f"Кэш пользователей: {len(user_index)}/{user_index.max_size}, вытеснено {user_index.evictions}")
+    print(f"Кэш расписаний: {len(schedule_cache)}/{schedule_cache.max_size}, вытеснено {schedule_cache.evictions}")
+    print(f"Состояние лимитов: {len(user_buckets)}/{user_buckets.max_size}")
+
+    # Вход пользователя и сброс токена после ответа 401 меняют одну запись в базе
+    started = time.perf_counter()
+    retrieve_schedule.save_user_token(REGISTERED_USERS, "new_student", "y" * 300)
+    retrieve_schedule.save_user_token(step, f"student_{step}", "z" * 300)
+    retrieve_schedule.remove_user_token(2 * step)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    print(f"Вход двух пользователей и сброс токена: {elapsed * 1000:.1f} мс, "
+          f"память {rss_mb():.1f} МБ, пиковая память {peak_rss_mb():.1f} МБ (было {active_peak:.1f} МБ)")
+
+    # Однократный перенос старого users.json в новую базу при первом запуске
+    os.chdir(tempfile.mkdtemp())
+    write_users_file(user_store.USER_DATA_FILE)
+    user_store.connection = None
+    before_peak = peak_rss_mb()
+    started = time.perf_counter()
+    migrated = user_store.count_users()  # Перенос выполняется при первом подключении к базе
+    elapsed = time.perf_counter() - started
+    print(f"Однократный перенос users.json ({migrated} записей): {elapsed:.2f} с, "
+          f"пиковая память {peak_rss_mb():.1f} МБ (было {before_peak:.1f} МБ)")
+
+if __name__ == "__main__":
+    main()
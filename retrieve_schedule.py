@@ -1,11 +1,13 @@
 import requests
-import json
+import sqlite3
 from datetime import datetime, timedelta
 import pytz  # Для работы с часовыми поясами
 import logging
 from config import SCHEDULE_URL, USER_AGENT, ORIGIN, REFERER
+from cache import user_index, schedule_cache  # Ограниченные по размеру кэши
+from throttling import acquire_upstream_call  # Общий лимит обращений к msapi
+from user_store import get_user, save_user, clear_user_token  # Хранилище пользователей (SQLite)
 
-USER_DATA_FILE = "users.json"
 MOSCOW_TZ = pytz.timezone("Europe/Moscow")  # Московский часовой пояс
 
 class MoscowTimeFormatter(logging.Formatter):
@@ -14,60 +16,57 @@ class MoscowTimeFormatter(logging.Formatter):
         tz_aware_time = datetime.fromtimestamp(record.created, tz=MOSCOW_TZ)
         return tz_aware_time.strftime(datefmt or self.default_time_format)
 
+def get_user_entry(user_id):
+    """
+    Получение записи пользователя через кэш активных пользователей.
+    При промахе из базы читается только запись этого пользователя.
+    """
+    key = str(user_id)
+    entry = user_index.get(key)
+    if entry is None:
+        try:
+            entry = get_user(key) or {}
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при чтении данных пользователя {key} из базы: {e}")
+            return {}
+        user_index.set(key, entry)
+    return entry
+
 def get_user_token(user_id):
-    try:
-        with open('users.json', 'r') as f:
-            tokens = json.load(f)
+    # Возвращаем None, если токен не найден
+    return get_user_entry(user_id).get("token")
 
-        # Проверяем, что пользователь существует и у него есть токен
-        user_data = tokens.get(str(user_id))
-        if user_data and 'token' in user_data:
-            return user_data['token']  # Возвращаем токен
-        else:
-            return None  # Возвращаем None, если токен не найден
-        
-    except FileNotFoundError:
-        print("Файл users.json не найден.")
-        return None
-    except json.JSONDecodeError:
-        print("Ошибка при декодировании JSON.")
-        return None
-    except Exception as e:
-        print(f"Произошла ошибка: {e}")
-        return None
+def forget_cached_user(user_id):
+    # Убираем из кэшей запись пользователя и расписания, полученные с его прежним токеном
+    user_index.pop(str(user_id))
+    schedule_cache.remove_where(lambda key: key[0] == str(user_id))
+
+def save_user_token(user_id, username, token):
+    # Сохраняем токен пользователя, остальные записи не читаются и не перезаписываются
+    forget_cached_user(user_id)
+    try:
+        save_user(user_id, username, token)
+        logger.info(f"Токен для пользователя {username} сохранен.")
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при сохранении данных: {e}")
 
 def remove_user_token(user_id):
     username = get_username(user_id)
+    forget_cached_user(user_id)
     try:
-        with open('users.json', 'r') as f:
-            tokens = json.load(f)
-        
-        # Проверяем, существует ли пользователь
-        if str(user_id) in tokens:
-            # Обнуляем токен для пользователя
-            tokens[str(user_id)]["token"] = ""
-            # Перезаписываем файл с обновлёнными токенами
-            with open('users.json', 'w') as f:
-                json.dump(tokens, f, indent=4)
+        # Обнуляем токен для пользователя
+        if clear_user_token(user_id):
             logger.info(f"Токен для пользователя {username} обнулён.")
         else:
             logger.warning(f"Токен для пользователя {username} не найден.")
-    except FileNotFoundError:
-        logger.error("Файл токенов не найден.")
-    except KeyError:
-        logger.error(f"Ошибка структуры данных для пользователя {username}.")
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при обнулении токена пользователя {username}: {e}")
 
 def get_username(user_id):
     """
-    Получение имени пользователя (username) по user_id из файла users.json.
+    Получение имени пользователя (username) по user_id из базы пользователей.
     """
-    try:
-        with open(USER_DATA_FILE, "r", encoding="utf-8") as file:
-            user_data = json.load(file)
-        return user_data.get(str(user_id), {}).get("username", f"User_{user_id}")
-    except FileNotFoundError:
-        logger.error(f"Файл {USER_DATA_FILE} не найден.")
-        return f"User_{user_id}"
+    return get_user_entry(user_id).get("username", f"User_{user_id}")
 
 # Настройка логирования
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
@@ -89,8 +88,7 @@ logger = logging.getLogger(__name__)
 def get_headers(user_id):
     username = get_username(user_id)
     logger.debug(f"Получение заголовков для пользователя {username}.")
-    user_data = load_user_data()
-    token = user_data.get(str(user_id), {}).get("token")
+    token = get_user_token(user_id)
     if token is None:
         logger.error(f"Токен пользователя {username} не найден.")
         raise ValueError("Токен пользователя не найден.")
@@ -106,17 +104,6 @@ def get_headers(user_id):
     logger.debug(f"Заголовки для пользователя {username} успешно получены.")
     return headers
 
-def load_user_data():
-    try:
-        logger.info("Загрузка данных пользователя из файла.")
-        with open(USER_DATA_FILE, "r", encoding="utf-8") as file:
-            data = json.load(file)
-            logger.info("Данные пользователя успешно загружены.")
-            return data
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logger.error(f"Ошибка при загрузке данных: {e}")
-        return {}
-
 def fetch_schedule(date, user_id):
     from bot import start
     from bot import handle_date_request
@@ -124,6 +111,7 @@ def fetch_schedule(date, user_id):
     logger.info(f"Запрос расписания для пользователя {username} на дату {date}.")
     url = SCHEDULE_URL.format(date)
     headers = get_headers(user_id)
+    acquire_upstream_call()  # Выбрасывает UpstreamBusyError, если общий лимит исчерпан
     
     try:
         response = requests.get(url, headers=headers)
@@ -181,6 +169,13 @@ def get_schedule(date, user_id):
         logger.error(f"Неверный формат даты для пользователя {username}: {date}. Используйте YYYY-MM-DD.")
         raise ValueError("Неверный формат даты. Используйте YYYY-MM-DD.")
     
+    # Готовое расписание могло быть получено недавно
+    cache_key = (str(user_id), date)
+    cached = schedule_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"Расписание для {username} на {date} взято из кэша.")
+        return cached.decode("utf-8")
+
     # Получаем расписание
     response = fetch_schedule(date, user_id)
     
@@ -195,7 +190,10 @@ def get_schedule(date, user_id):
         logger.error(f"Ошибка при разборе ответа для пользователя {username} на {date}. Ответ не в формате JSON.")
         raise ValueError("Ошибка при разборе данных расписания. Ответ не в формате JSON.")
     
-    return format_schedule(schedule_info, date)  # Форматируем расписание для отправки
+    formatted_schedule = format_schedule(schedule_info, date)  # Форматируем расписание для отправки
+    # Текст с эмодзи в виде str занимает 4 байта на символ, в UTF-8 - в 2-3 раза меньше
+    schedule_cache.set(cache_key, formatted_schedule.encode("utf-8"))
+    return formatted_schedule
 
 
 def get_today_schedule(user_id):
@@ -0,0 +1,129 @@
+import time
+import logging
+from collections import Counter
+from config import (
+    USER_RATE_CAPACITY, USER_RATE_REFILL,
+    GLOBAL_RATE_CAPACITY, GLOBAL_RATE_REFILL,
+    THROTTLE_NOTICE_INTERVAL, THROTTLE_STATE_SIZE, IDLE_USER_TTL,
+)
+from cache import BoundedCache
+
+# Создание логгера
+logger = logging.getLogger(__name__)
+
+# Готовый ответ при превышении лимита, чтобы не тратить ресурсы на его формирование
+TOO_OFTEN_REPLY = "Слишком часто! Подождите немного и повторите запрос."
+UPSTREAM_BUSY_REPLY = "Слишком часто! Сервер расписания сейчас перегружен, повторите запрос чуть позже."
+
+class UpstreamBusyError(Exception):
+    """
+    Общий лимит обращений к msapi исчерпан, запрос к серверу не выполнялся.
+    """
+
+# Счётчики для метрик бота: сколько сообщений пропущено и сколько отклонено.
+# rejected_global_messages считается в сообщениях, rejected_global_calls - в запросах к msapi.
+throttle_metrics = Counter()
+
+class TokenBucket:
+    """
+    Корзина токенов: capacity - максимум запросов подряд, refill_rate - токенов в секунду.
+    """
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_rate)
+        self.updated = now
+
+    def has_tokens(self, amount=1):
+        self._refill(time.monotonic())
+        return self.tokens >= amount
+
+    def try_consume(self, amount=1):
+        self._refill(time.monotonic())
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def refund(self, amount=1):
+        # Возвращаем токены, если запрос всё-таки не был выполнен
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+# Персональные корзины пользователей и общая корзина обращений к msapi.
+# Корзина неактивного пользователя к моменту удаления всё равно была бы полной.
+user_buckets = BoundedCache(THROTTLE_STATE_SIZE, ttl=IDLE_USER_TTL)
+global_bucket = TokenBucket(GLOBAL_RATE_CAPACITY, GLOBAL_RATE_REFILL)
+
+# Пользователи, которым недавно отвечали "слишком часто" (запись живёт THROTTLE_NOTICE_INTERVAL секунд)
+last_notice = BoundedCache(THROTTLE_STATE_SIZE, ttl=THROTTLE_NOTICE_INTERVAL)
+
+def _get_user_bucket(user_id):
+    bucket = user_buckets.get(user_id)
+    if bucket is None:
+        bucket = TokenBucket(USER_RATE_CAPACITY, USER_RATE_REFILL)
+    user_buckets.set(user_id, bucket)  # Продлеваем срок жизни при каждом обращении
+    return bucket
+
+def should_notify(user_id):
+    # Отвечаем "слишком часто" не чаще раза в THROTTLE_NOTICE_INTERVAL секунд
+    if last_notice.get(user_id) is None:
+        last_notice.set(user_id, True)
+        return True
+    return False
+
+def refund_user(user_id, amount):
+    # Возвращаем пользователю токены за запросы к msapi, которые так и не были выполнены
+    bucket = user_buckets.get(user_id)
+    if bucket is not None:
+        bucket.refund(amount)
+
+def check_rate_limit(user_id, upstream_calls=0):
+    """
+    Проверка лимитов перед обработкой сообщения.
+    upstream_calls - сколько запросов к msapi может потребовать сообщение,
+    столько же (но не меньше 1) списывается с персонального лимита.
+    Общий лимит здесь только проверяется, списывается он в acquire_upstream_call.
+    Возвращает None, если сообщение можно обрабатывать, иначе текст ответа
+    (пустая строка - ответ уже отправлялся недавно, сообщение нужно молча пропустить).
+    В лог отказ пишется только вместе с ответом пользователю, чтобы спам не превращался в спам логов.
+    """
+    cost = max(1, upstream_calls)
+    user_bucket = _get_user_bucket(user_id)
+    if not user_bucket.try_consume(cost):
+        throttle_metrics["rejected_user"] += 1
+        if should_notify(user_id):
+            logger.warning(f"Пользователь {user_id} превысил персональный лимит запросов.")
+            return TOO_OFTEN_REPLY
+        return ""
+
+    if upstream_calls and not global_bucket.has_tokens(upstream_calls):
+        user_bucket.refund(cost)
+        throttle_metrics["rejected_global_messages"] += 1
+        if should_notify(user_id):
+            logger.warning(f"Общий лимит запросов к серверу исчерпан, запрос пользователя {user_id} отклонён.")
+            return UPSTREAM_BUSY_REPLY
+        return ""
+
+    throttle_metrics["allowed"] += 1
+    return None
+
+def acquire_upstream_call():
+    # Списываем общий лимит непосредственно перед запросом к msapi.
+    # Отказ пишет в лог обработчик, когда отвечает пользователю.
+    if not global_bucket.try_consume():
+        throttle_metrics["rejected_global_calls"] += 1
+        raise UpstreamBusyError("Общий лимит запросов к серверу исчерпан.")
+    throttle_metrics["upstream_calls"] += 1
+
+def expire_idle_state():
+    # Удаляем состояние неактивных пользователей
+    return user_buckets.expire() + last_notice.expire()
+
+def get_throttle_stats():
+    # Снимок счётчиков для логов и метрик
+    return dict(throttle_metrics)
@@ -0,0 +1,71 @@
+import os
+import json
+import logging
+import sqlite3
+from config import USER_DB_FILE
+
+# Старый файл с данными пользователей, переносится в базу при первом запуске
+USER_DATA_FILE = "users.json"
+
+# Создание логгера
+logger = logging.getLogger(__name__)
+
+# Соединение открывается при первом обращении
+connection = None
+
+def get_connection():
+    global connection
+    if connection is None:
+        connection = sqlite3.connect(USER_DB_FILE, check_same_thread=False)
+        connection.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, username TEXT, token TEXT)")
+        connection.commit()
+        if count_users() == 0 and os.path.exists(USER_DATA_FILE):
+            migrate_from_json(USER_DATA_FILE)
+    return connection
+
+def migrate_from_json(path):
+    # Однократный перенос users.json в базу: файл читается целиком только здесь
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            user_data = json.load(file)
+    except json.JSONDecodeError:
+        logger.error(f"Файл {path} повреждён, пользователи не перенесены в базу.")
+        return
+    import_users(user_data.items())
+    logger.info(f"Из файла {path} в базу {USER_DB_FILE} перенесено пользователей: {len(user_data)}.")
+
+def import_users(entries):
+    # Массовая запись пар (user_id, {"username": ..., "token": ...}) одной транзакцией
+    with get_connection() as db:
+        db.executemany(
+            "INSERT OR REPLACE INTO users (user_id, username, token) VALUES (?, ?, ?)",
+            ((str(user_id), entry.get("username"), entry.get("token")) for user_id, entry in entries),
+        )
+
+def count_users():
+    return get_connection().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+def get_user(user_id):
+    """
+    Запись пользователя {"username": ..., "token": ...} или None, если пользователя нет.
+    """
+    row = get_connection().execute(
+        "SELECT username, token FROM users WHERE user_id = ?", (str(user_id),)
+    ).fetchone()
+    if row is None:
+        return None
+    return {"username": row[0], "token": row[1]}
+
+def save_user(user_id, username, token):
+    # Добавляем или обновляем одну запись, остальные пользователи не читаются и не перезаписываются
+    with get_connection() as db:
+        db.execute(
+            "INSERT OR REPLACE INTO users (user_id, username, token) VALUES (?, ?, ?)",
+            (str(user_id), username, token),
+        )
+
+def clear_user_token(user_id):
+    # Обнуляем токен пользователя, возвращаем False, если пользователя нет
+    with get_connection() as db:
+        cursor = db.execute("UPDATE users SET token = '' WHERE user_id = ?", (str(user_id),))
+    return cursor.rowcount > 0